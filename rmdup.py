@@ -12,117 +12,959 @@
 
 
 import os
+import sys
 import hashlib
-from collections import defaultdict
+import mmap
+import signal
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict, namedtuple
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from argparse import ArgumentParser
 
-def get_md5(file_path):
-    """Calculate the MD5 checksum of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def get_file_size(file_path):
-    """Get the size of a file in a human-readable format."""
-    size = os.path.getsize(file_path)
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024:
-            return f"{size:.2f} {unit}"
-        size /= 1024
-    return f"{size:.2f} TB"
-
-def find_duplicates(directory):
-    """Find duplicate files in the specified directory."""
-    checksums = defaultdict(list)
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_checksum = get_md5(file_path)
-            checksums[file_checksum].append(file_path)
-    
-    return {k: v for k, v in checksums.items() if len(v) > 1}
+try:
+    import blake3  # Optional, several times faster than MD5
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash  # Optional, faster still but not cryptographic
+except ImportError:
+    xxhash = None
+
+try:
+    import fastcdc  # Optional, only needed for --cdc
+except ImportError:
+    fastcdc = None
+
+# Bytes from the start and end of a file hashed by the quick first pass
+# that weeds out same-size files before their full contents are read.
+HEAD_SIZE = 65536
+TAIL_SIZE = 4096
+
+# Largest head --prefix-size accepts.  The head of each file is read into
+# memory in one piece, and past a few MiB a full hash is just as cheap.
+MAX_HEAD_SIZE = 8 << 20
+
+# Default read size used when hashing whole files, set with --blocksize.
+CHUNK_SIZE = 1 << 20
+
+# Files larger than this are memory-mapped for hashing instead of read.
+MMAP_THRESHOLD = 1 << 20
+
+# Files larger than this are hashed by several threads at once, in pieces
+# of PIECE_SIZE unless the hash is BLAKE3, which does that internally.
+PARALLEL_HASH_THRESHOLD = 64 << 20
+PIECE_SIZE = 8 << 20
+
+# Most threads hashing one file.  Each holds a PIECE_SIZE read, and the
+# process pool may be hashing several large files at once.
+MAX_FILE_THREADS = 4
+
+# Groups of same-size files up to this many are hashed side by side, so
+# reading can stop wherever a file first differs from all the others.
+# Each file in such a group is kept open until it is dropped or finished.
+LOCKSTEP_MAX_FILES = 32
+
+# Larger groups are first split on windows of their files past the quick
+# pass's sample, starting at this size and doubling each round up to
+# PIECE_SIZE, until they are small enough to hash in lockstep.  Splitting
+# stops early after SPLIT_MAX_ROUNDS, or once a round splits nothing.
+SPLIT_WINDOW_SIZE = 1 << 20
+SPLIT_MAX_ROUNDS = 6
+
+# Groups up to this many are compared byte by byte instead, when there is
+# no cache to keep checksums in.  Every file is compared with each group
+# it could belong to, which stops paying off for larger groups.
+COMPARE_MAX_FILES = 4
+
+# Average chunk size for --cdc, and how much of the smaller file two files
+# must share before they are reported as near-duplicates.
+CDC_AVG_SIZE = 8192
+CDC_MIN_OVERLAP = 0.5
+
+# Chunks found in more files than this, such as a common header or a
+# block of zeros, are ignored by --cdc.  They say nothing about which
+# files are alike, and every file sharing one would be paired with every
+# other.
+CDC_MAX_SHARERS = 32
+
+# Where checksums are kept between runs.
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                          'rmdup', 'hashes.db')
+
+# New cache entries are written to disk in batches of this many.
+CACHE_BATCH_SIZE = 1000
+
+# Files modified less than this many nanoseconds ago aren't cached.
+RACY_MTIME_NS = 2 * 10**9
+
+# What the scan records about each file, so later stages never stat again.
+FileInfo = namedtuple('FileInfo', 'size mtime_ns ctime_ns dev inode')
+
+# Units used by get_human_size.
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB')
+
+# Threads used to unlink the files chosen for deletion.
+DELETE_THREADS = 16
+
+# Default number of hashing processes.  Past about this many the disk,
+# not the CPU, is what limits hashing, and each extra process only adds
+# seeking and open files.
+MAX_HASH_JOBS = 8
+
+# Hash algorithms that can be picked with --hash, each as an initialized
+# hash object.  Copying one is cheaper than constructing a new one, and
+# make_hasher runs once for every file looked at.
+HASH_ALGORITHMS = ('blake3', 'xxh3', 'md5')
+_BASE_HASHERS = {'md5': hashlib.md5()}
+if blake3 is not None:
+    _BASE_HASHERS['blake3'] = blake3.blake3()
+if xxhash is not None:
+    _BASE_HASHERS['xxh3'] = xxhash.xxh3_128()
+
+# blake3 if its package is installed.  xxh3 is not cryptographic, so it is
+# only used when asked for.
+DEFAULT_HASH = next(name for name in ('blake3', 'md5') if name in _BASE_HASHERS)
+
+# Per-thread state for the hashing functions, which may run in threads.
+_thread_state = threading.local()
+
+def ignore_sigint():
+    """Make a pool worker leave Ctrl-C to the main process.
+
+    Otherwise every worker prints its own KeyboardInterrupt traceback.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def make_hasher(name):
+    """Return a fresh hash object for the named algorithm."""
+    return _BASE_HASHERS[name].copy()
+
+def get_read_buffer(blocksize=CHUNK_SIZE):
+    """Return this thread's read buffer, reused for every file."""
+    buffer = getattr(_thread_state, 'buffer', None)
+    if buffer is None or len(buffer) != blocksize:
+        buffer = _thread_state.buffer = memoryview(bytearray(blocksize))
+    return buffer
+
+def update_from_mmap(hasher, f):
+    """Feed an open file to hasher through a memory map.
+
+    Returns False without touching hasher if the file can't be mapped,
+    which some network and FUSE filesystems don't support.
+    """
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with mm:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        # Hash straight from the page cache in one C-level update
+        hasher.update(mm)
+    return True
+
+def update_from_reads(hasher, f, blocksize=CHUNK_SIZE):
+    """Feed an open unbuffered file to hasher in blocksize reads."""
+    if hasattr(os, 'posix_fadvise'):
+        # Widen the kernel's readahead so the next chunk is being read
+        # while the current one is hashed
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    buffer = get_read_buffer(blocksize)
+    readinto, update = f.readinto, hasher.update
+    while n := readinto(buffer):
+        # Only the last read is short, so don't slice a view for the rest
+        update(buffer if n == blocksize else buffer[:n])
+
+def get_hash(file_path, size, algorithm, blocksize=CHUNK_SIZE, drop_cache=True,
+             threads=1):
+    """Calculate the checksum of a file that is size bytes long.
+
+    blocksize is the read size used when the file isn't memory-mapped.
+    Unless drop_cache is false, the file is dropped from the page cache
+    once it has been read.  A file over PARALLEL_HASH_THRESHOLD is hashed
+    by up to threads threads; the checksum is the same for any number.
+    """
+    if (size > PARALLEL_HASH_THRESHOLD and algorithm != 'blake3'
+            and hasattr(os, 'pread')):
+        return get_tree_hash(file_path, size, algorithm, drop_cache, threads)
+    hasher = make_hasher(algorithm)
+    # Unbuffered, since reads go straight into our own buffer
+    with open(file_path, 'rb', buffering=0) as f:
+        if algorithm == 'blake3':
+            if size > PARALLEL_HASH_THRESHOLD and threads > 1:
+                # BLAKE3 is a tree hash already, so it can spread one file
+                # over several threads without changing the result
+                hasher = blake3.blake3(max_threads=threads)
+            # Let BLAKE3 map the file itself rather than feeding it chunks
+            hasher.update_mmap(file_path)
+        elif size <= MMAP_THRESHOLD or not update_from_mmap(hasher, f):
+            update_from_reads(hasher, f, blocksize)
+        if drop_cache and hasattr(os, 'posix_fadvise'):
+            # Nothing reads the file again, so don't let it push the rest
+            # of the machine's working set out of the page cache
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return hasher.digest()
+
+def get_tree_hash(file_path, size, algorithm, drop_cache=True, threads=1):
+    """Calculate the checksum of a large file using up to threads threads.
+
+    The file is hashed as PIECE_SIZE pieces, in parallel unless threads is
+    1, and the checksum is the hash of the piece digests.  It differs from
+    the plain checksum of the file, which is fine since get_hash uses it
+    for every file of the same size.
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        def hash_piece(offset):
+            hasher = make_hasher(algorithm)
+            hasher.update(os.pread(fd, PIECE_SIZE, offset))
+            return hasher.digest()
+
+        hasher = make_hasher(algorithm)
+        offsets = range(0, size, PIECE_SIZE)
+        if threads == 1:
+            # One piece after another, so the file is still read in order
+            for offset in offsets:
+                hasher.update(hash_piece(offset))
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for digest in executor.map(hash_piece, offsets):
+                    hasher.update(digest)
+        if drop_cache and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return hasher.digest()
+
+def open_sequential(stack, file_path, drop_cache=True):
+    """Open a file that will be read once, front to back, on an ExitStack.
+
+    Like get_hash, this widens the kernel's readahead and, unless
+    drop_cache is false, drops the file from the page cache when the
+    stack closes it.
+    """
+    f = stack.enter_context(open(file_path, 'rb'))
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if drop_cache:
+            # Callbacks run in reverse, so this comes before the file is closed
+            stack.callback(lambda: os.posix_fadvise(f.fileno(), 0, 0,
+                                                    os.POSIX_FADV_DONTNEED))
+    return f
+
+def read_in_turn(files, buffer):
+    """Yield up to len(buffer) bytes read from each of files in turn.
+
+    Each chunk is a view of buffer, valid until the next one is asked for.
+    """
+    for f in files:
+        yield buffer[:f.readinto(buffer)]
+
+def read_ahead(files, executor, buffers):
+    """Like read_in_turn, but the next file is read in a thread.
+
+    While the caller works on the data from one file, executor reads the
+    next into the other of the two buffers, so waiting on the disk
+    overlaps with hashing.  Each file is read for the length of a buffer.
+    """
+    def read(f, buffer):
+        return buffer[:f.readinto(buffer)]
+
+    pending = None
+    for i, f in enumerate(files):
+        # The caller is done with the buffer used two files back
+        future = executor.submit(read, f, buffers[i % 2])
+        if pending is not None:
+            yield pending.result()
+        pending = future
+    if pending is not None:
+        yield pending.result()
+
+def hash_in_lockstep(paths, size, algorithm, blocksize=CHUNK_SIZE, drop_cache=True):
+    """Hash files of the same size side by side, one chunk at a time.
+
+    After each chunk a file whose checksum so far matches no other file's
+    is dropped, so files that only share a size stop being read where they
+    first differ, blocksize bytes at a time.  Returns {path: checksum} for
+    the files read to the end, each checksum being the same one get_hash
+    would give.
+    """
+    # Hash large files in the same pieces as get_tree_hash
+    tree = (size > PARALLEL_HASH_THRESHOLD and algorithm != 'blake3'
+            and hasattr(os, 'pread'))
+    step = PIECE_SIZE if tree else blocksize
+    hashers = {file_path: make_hasher(algorithm) for file_path in paths}
+    with ExitStack() as stack:
+        files = {file_path: open_sequential(stack, file_path, drop_cache)
+                 for file_path in paths}
+        read_thread = None
+        if size > PARALLEL_HASH_THRESHOLD:
+            # Worth a thread to keep the disk busy during each update.  It
+            # is shut down before the files are closed.
+            read_thread = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+            buffers = [memoryview(bytearray(step)) for i in range(2)]
+        else:
+            buffer = memoryview(bytearray(step))
+        for offset in range(0, size, step):
+            running = defaultdict(list)
+            if read_thread is not None:
+                reads = read_ahead(files.values(), read_thread, buffers)
+            else:
+                reads = read_in_turn(files.values(), buffer)
+            for file_path, data in zip(files, reads):
+                if tree:
+                    piece = make_hasher(algorithm)
+                    piece.update(data)
+                    data = piece.digest()
+                hasher = hashers[file_path]
+                hasher.update(data)
+                running[hasher.copy().digest()].append(file_path)
+            for same in running.values():
+                if len(same) == 1:
+                    del files[same[0]]  # Closed along with the rest
+            if not files:
+                break
+        return {file_path: hashers[file_path].digest() for file_path in files}
+
+def compare_in_lockstep(paths, size, blocksize=CHUNK_SIZE, drop_cache=True):
+    """Split files of the same size into groups with identical contents.
+
+    The files are read side by side, blocksize bytes at a time, and
+    compared directly, so nothing is hashed and a file stops being read as
+    soon as it matches no other.  Returns the groups of two or more files.
+    """
+    with ExitStack() as stack:
+        groups = [[(file_path, open_sequential(stack, file_path, drop_cache))
+                   for file_path in paths]]
+        for offset in range(0, size, blocksize):
+            split = []
+            for group in groups:
+                same_data = []  # (data, files that read it) pairs
+                for file_path, f in group:
+                    data = f.read(blocksize)
+                    for seen, members in same_data:
+                        if seen == data:
+                            members.append((file_path, f))
+                            break
+                    else:
+                        same_data.append((data, [(file_path, f)]))
+                split.extend(members for data, members in same_data if len(members) > 1)
+            groups = split
+            if not groups:
+                break
+        return [[file_path for file_path, f in group] for group in groups]
+
+def split_by_windows(paths, size, offset, blocksize=CHUNK_SIZE):
+    """Split a large group of same-size files on windows of their data.
+
+    Files are grouped by a CRC-32 of a window starting at offset, and
+    those alone in their group are dropped.  Groups still too large to
+    hash in lockstep are split again on the next window, which is twice
+    as long up to PIECE_SIZE.  This stops when the windows reach the tail
+    the quick pass already compared, after SPLIT_MAX_ROUNDS, or when a
+    round splits nothing, as it won't for a group of identical files.
+    Returns the remaining groups of paths.
+    """
+    groups = [paths]
+    length = SPLIT_WINDOW_SIZE
+    for i in range(SPLIT_MAX_ROUNDS):
+        large = [group for group in groups if len(group) > LOCKSTEP_MAX_FILES]
+        if not large or offset >= size - TAIL_SIZE:
+            break
+        split = [group for group in groups if len(group) <= LOCKSTEP_MAX_FILES]
+        progress = False
+        for group in large:
+            windows = defaultdict(list)
+            for file_path in group:
+                fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                try:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    crc, left = 0, length
+                    while left > 0 and (data := os.read(fd, min(blocksize, left))):
+                        crc = zlib.crc32(data, crc)
+                        left -= len(data)
+                finally:
+                    os.close(fd)
+                windows[crc].append(file_path)
+            same = [smaller for smaller in windows.values() if len(smaller) > 1]
+            if len(same) != 1 or len(same[0]) != len(group):
+                progress = True
+            split.extend(same)
+        groups = split
+        if not progress:
+            break
+        offset += length
+        length = min(length * 2, PIECE_SIZE)
+    return groups
+
+def get_quick_hash(file_path, size, algorithm, head_size=HEAD_SIZE):
+    """Calculate a checksum of the start and end of a file.
+
+    Files no longer than head_size get their full checksum, or None if
+    fewer than size bytes could be read because the file shrank since it
+    was scanned.  For larger ones this covers the first head_size and last
+    TAIL_SIZE bytes and is only a prefilter ahead of get_hash, so a CRC-32
+    is used.
+    """
+    # Called once for every file in a size bucket, which on trees full of
+    # small files is most of them, so use a bare descriptor instead of
+    # paying for a buffered file object
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        # A read can return less than asked for, on FUSE or NFS or past
+        # the most Linux hands back at once, so keep going until EOF
+        pieces = []
+        left = min(size, head_size)
+        while left:
+            piece = os.read(fd, left)
+            if not piece:
+                break
+            pieces.append(piece)
+            left -= len(piece)
+        head = b"".join(pieces)
+        if size > head_size:
+            # Files with a common header, such as media from one camera,
+            # often still differ at the end
+            os.lseek(fd, max(head_size, size - TAIL_SIZE), os.SEEK_SET)
+            return zlib.crc32(os.read(fd, TAIL_SIZE), zlib.crc32(head))
+        if len(head) != size:
+            return None
+        hasher = make_hasher(algorithm)
+        hasher.update(head)
+        return hasher.digest()
+    finally:
+        os.close(fd)
+
+def is_rotational(path):
+    """Return True if path is on a spinning disk, as far as Linux reports.
+
+    Anything that can't be checked, including every other OS, counts as
+    not rotational.  So do virtio disks and device-mapper volumes, which
+    report themselves as rotational whatever is behind them; that would
+    make most cloud VMs scan and hash serially.
+    """
+    try:
+        dev = os.stat(path).st_dev
+        block = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+        if '/virtio' in block or os.path.basename(block).startswith('dm-'):
+            return False
+        # A partition has no queue of its own, its disk is the parent
+        for base in (block, os.path.dirname(block)):
+            flag = os.path.join(base, 'queue', 'rotational')
+            if os.path.exists(flag):
+                with open(flag) as f:
+                    return f.read().strip() == '1'
+    except (OSError, AttributeError):
+        pass
+    return False
+
+@lru_cache(maxsize=4096)
+def get_human_size(size):
+    """Format a size in bytes in a human-readable format."""
+    # Each unit is 2**10 times the last, so the bit length picks it
+    i = min(max(0, (size.bit_length() - 1) // 10), len(SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * i)):.2f} {SIZE_UNITS[i]}"
+
+def scan_directory(path):
+    """List one directory, returning its regular files and subdirectories.
+
+    Files are returned as DirEntry objects whose lstat has already been
+    done, so calling entry.stat(follow_symlinks=False) later is free.
+    Symlinks are skipped.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return [], []  # Unreadable directory, skipped just like os.walk does
+    files, subdirs = [], []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                entry.stat(follow_symlinks=False)
+                files.append(entry)
+        except OSError:
+            continue  # File vanished during the scan
+    return files, subdirs
+
+def scantree(path, workers=None):
+    """Yield a DirEntry for every regular file under path, skipping symlinks.
+
+    Directories are listed by a pool of worker threads, each one queueing
+    its subdirectories as soon as it has read them, so the whole tree is
+    being listed in parallel.  Files still come out in the same order as a
+    serial walk: those in a directory before those in its subdirectories.
+    If workers is 1 the tree is walked serially.
+    """
+    if workers == 1:
+        files, subdirs = scan_directory(path)
+        yield from files
+        for subdir in subdirs:
+            yield from scantree(subdir, workers)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def scan(path):
+            files, subdirs = scan_directory(path)
+            return files, [executor.submit(scan, subdir) for subdir in subdirs]
+
+        def collect(future):
+            files, subdirs = future.result()
+            yield from files
+            for subdir in subdirs:
+                yield from collect(subdir)
+
+        yield from collect(executor.submit(scan, path))
+
+def scan_files(directory, jobs=None, aliases=None):
+    """Yield (path, FileInfo) for every file under directory.
+
+    Hard links share their data, so only the first link found to each file
+    is yielded; deleting a link frees no space while another one remains.
+    If aliases is a dict, the other links are collected in it as
+    {first link: [other links]}.
+    """
+    seen_inodes = {}
+    for entry in scantree(directory, jobs):
+        st = entry.stat(follow_symlinks=False)
+        if st.st_nlink > 1:
+            inode = (st.st_dev, st.st_ino)
+            first = seen_inodes.get(inode)
+            if first is not None:
+                if aliases is not None:
+                    aliases.setdefault(first, []).append(entry.path)
+                continue
+            seen_inodes[inode] = entry.path
+        yield entry.path, FileInfo(st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                                     st.st_dev, st.st_ino)
+
+class HashCache:
+    """Checksums from earlier runs, kept in an SQLite database.
+
+    Entries are keyed by device and inode, so a file that is renamed or
+    moved within its filesystem keeps its checksum.  An entry is only used
+    while the file's size, mtime and ctime are the same as when it was
+    hashed, and only for the same hash algorithm.  The mtime can be set
+    back after an edit, but the ctime can't, and it also tells apart
+    files that get the same device and inode numbers on another mount.
+
+    If the database fails during the run, for instance because it can't
+    be written or another run holds a lock on it, a warning is printed
+    once and the run carries on as if there were no cache.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS inode_hashes (dev INTEGER, inode INTEGER, "
+                        "size INTEGER, mtime_ns INTEGER, algorithm TEXT, hash BLOB, "
+                        "ctime_ns INTEGER, PRIMARY KEY (dev, inode))")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(inode_hashes)")]
+        if 'ctime_ns' not in columns:
+            # Written by a version that didn't record the ctime.  Its rows
+            # are left NULL, so they never match and get replaced.
+            self.db.execute("ALTER TABLE inode_hashes ADD COLUMN ctime_ns INTEGER")
+        self.pending = []  # Rows stored since the last flush
+        self.failed = False
+
+    def fail(self, error):
+        """Stop using the database after an error, saying so once."""
+        if not self.failed:
+            print(f"Not using the hash cache: {error}")
+            self.failed = True
+        self.pending = []
+
+    def lookup(self, info, algorithm):
+        """Return the cached checksum of a file, or None."""
+        if self.failed:
+            return None
+        try:
+            row = self.db.execute("SELECT size, mtime_ns, ctime_ns, algorithm, hash "
+                                  "FROM inode_hashes WHERE dev = ? AND inode = ?",
+                                  (info.dev, info.inode)).fetchone()
+        except sqlite3.Error as e:
+            self.fail(e)
+            return None
+        if row is not None and row[:4] == (info.size, info.mtime_ns, info.ctime_ns, algorithm):
+            return row[4]
+        return None
+
+    def store(self, info, algorithm, file_hash):
+        """Remember the checksum of a file as it was when info was taken."""
+        if self.failed:
+            return
+        if time.time_ns() - info.mtime_ns < RACY_MTIME_NS:
+            # A file written this recently could change again without its
+            # mtime moving on a coarse-grained filesystem, so don't trust it
+            return
+        self.pending.append((info.dev, info.inode, info.size, info.mtime_ns,
+                             info.ctime_ns, algorithm, file_hash))
+        if len(self.pending) >= CACHE_BATCH_SIZE:
+            # Don't lose a long run's work if it is killed before close
+            self.flush()
+
+    def flush(self):
+        """Write the checksums stored so far to disk."""
+        if self.failed:
+            return
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO inode_hashes (dev, inode, size, mtime_ns, "
+                                "ctime_ns, algorithm, hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                self.pending)
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.fail(e)
+        self.pending = []
+
+    def close(self):
+        """Write everything stored during the run to disk."""
+        self.flush()
+        try:
+            self.db.close()
+        except sqlite3.Error:
+            pass  # Already reported by flush, or nothing left to lose
+
+def find_duplicates(directory, jobs=None, debug=False, algorithm=DEFAULT_HASH,
+                    cache=None, prefix_size=HEAD_SIZE, blocksize=CHUNK_SIZE, aliases=None,
+                    drop_cache=True):
+    """Find duplicate files in the specified directory.
+
+    Yields ((size, checksum), paths) for each group of duplicates as soon as
+    the group is known, so callers can start on it while hashing goes on.
+    checksum is None for empty files and for files compared byte by byte.
+    jobs is the number of threads used for listing directories and of
+    processes used for hashing, with None picking a default for each.
+    algorithm is one of the HASH_ALGORITHMS that is installed.  If cache is
+    a HashCache, full checksums are looked up in it and added to it.
+    prefix_size is how much of the start of each file the quick pass reads,
+    and blocksize the read size used for full checksums.  If aliases is a
+    dict, the hard links the scan skipped are collected in it as
+    {first link: [other links]}.  Unless drop_cache is false, files read
+    in full are dropped from the page cache afterwards.
+    """
+    # Only files of the same size can be duplicates, so bucket by size first
+    # and hash nothing but the buckets with more than one file in them.
+    # The stat info from the scan is kept with each path so nothing later
+    # has to stat the file again.
+    #
+    # Most same-size files already differ near the start or the end, so
+    # those are compared before reading anything else.  When the tree is
+    # listed in threads, a file is sampled as soon as another one has its
+    # size, so the reads overlap with the rest of the tree being listed.
+    # With a single job they would only interleave with the listing, so
+    # the sampling waits for the scan to finish.
+    size_map = defaultdict(list)
+    samples = defaultdict(lambda: defaultdict(list))  # {size: {sample: files}}
+    sample_early = jobs != 1
+    if aliases is None:
+        aliases = {}
+    for file_path, info in scan_files(directory, jobs, aliases):
+        files = size_map[info.size]
+        files.append((file_path, info))
+        if sample_early and info.size and len(files) > 1:
+            # The first file of this size waited for a second one
+            for path_info in files if len(files) == 2 else files[-1:]:
+                sample = get_quick_hash(path_info[0], info.size, algorithm, prefix_size)
+                samples[info.size][sample].append(path_info)
+    if not sample_early:
+        for size, files in size_map.items():
+            if size and len(files) > 1:
+                for path_info in files:
+                    sample = get_quick_hash(path_info[0], size, algorithm, prefix_size)
+                    samples[size][sample].append(path_info)
+
+    if debug:
+        linked = sum(len(links) for links in aliases.values())
+        print(f"Hard links to files already found, not hashed: {linked}")
+        sys.stdout.write("".join(f"  {file_path}: already hardlinked as {', '.join(links)}\n"
+                                 for file_path, links in aliases.items()))
+        unique = [size for size, paths in size_map.items() if len(paths) == 1]
+        print(f"Files with a unique size, not hashed: {len(unique)} ({get_human_size(sum(unique))})")
+        candidates = sum(len(paths) for paths in size_map.values() if len(paths) > 1)
+        print(f"Files sharing a size with another, to compare: {candidates}")
+
+    settled = []  # Groups confirmed without a full hash
+    to_hash = []  # (size, paths) groups that still need one
+    for size, files in size_map.items():
+        if len(files) < 2:
+            continue
+        if size == 0:
+            # Empty files are all identical, no need to read them
+            settled.append(((0, None), [file_path for file_path, info in files]))
+            continue
+        for sample, group in samples[size].items():
+            if len(group) < 2 or sample is None:
+                continue  # None if the files got shorter since the scan
+            if size <= prefix_size:
+                # The sample was the whole file, so its checksum is the full one
+                settled.append(((size, sample), [file_path for file_path, info in group]))
+                continue
+            to_hash.append((size, group))
+    # This generator stays alive until its last group is taken, so let go
+    # of the scan results, mostly files with a unique size, before hashing
+    del size_map, samples
+
+    # Reuse checksums from earlier runs for files that haven't changed
+    known = {}
+    if cache is not None:
+        for size, group in to_hash:
+            for file_path, info in group:
+                file_hash = cache.lookup(info, algorithm)
+                if file_hash is not None:
+                    known[file_path] = file_hash
+
+    # Groups are independent, so the full checksums are spread across a
+    # process pool to use every core.  Without one each group is hashed
+    # only when its turn comes.
+    #
+    # Large files can also be hashed by several threads each, sharing out
+    # the cores left over by the pool.  With a single job they are read
+    # front to back, since that is what a spinning disk needs.
+    executor = None
+    workers = jobs or min(MAX_HASH_JOBS, os.cpu_count() or 1)
+    threads = 1
+    if jobs != 1:
+        threads = max(1, min(MAX_FILE_THREADS, (os.cpu_count() or 1) // workers))
+    if jobs != 1 and sum(len(group) for size, group in to_hash) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint)
+
+    def schedule(function, *args):
+        if executor is None:
+            return lambda: function(*args)
+        return executor.submit(function, *args).result
+
+    def schedule_hashes(size, paths, lockstep):
+        """Return (file_path, result) pairs for the checksums of paths.
+
+        Calling result returns a checksum or, for file_path None, a dict
+        of them from hash_in_lockstep, which is used if lockstep is true
+        and there are few enough files.
+        """
+        if lockstep and len(paths) <= LOCKSTEP_MAX_FILES:
+            return [(None, schedule(hash_in_lockstep, paths, size, algorithm,
+                                    blocksize, drop_cache))]
+        return [(file_path, schedule(get_hash, file_path, size, algorithm,
+                                     blocksize, drop_cache, threads))
+                for file_path in paths]
+
+    # Each group gets a (kind, result) pair.  For 'compare', calling result
+    # returns the groups of identical files, and for 'split' the smaller
+    # groups that still need checksums.  For 'hash', result is a list of
+    # pairs from schedule_hashes.
+    pending = []
+    for size, group in to_hash:
+        paths = [file_path for file_path, info in group if file_path not in known]
+        # A file dropped by a comparison, split or lockstep matched no other
+        # in the group, which only holds when none of them came from the cache
+        uncached = len(paths) == len(group)
+        if cache is None and len(group) <= COMPARE_MAX_FILES:
+            # Nothing would keep the checksums, so skip computing them
+            pending.append(('compare', schedule(compare_in_lockstep, paths, size,
+                                                blocksize, drop_cache)))
+        elif uncached and len(group) > LOCKSTEP_MAX_FILES:
+            # Hashing a large group in full reads every file to the end even
+            # when they differ early on, so try to split it first
+            pending.append(('split', schedule(split_by_windows, paths, size,
+                                              prefix_size, blocksize)))
+        else:
+            pending.append(('hash', schedule_hashes(size, paths, uncached)))
+    try:
+        # Hand out what is already known while the pool works, then each
+        # group as soon as its last checksum arrives
+        yield from settled
+        for (size, group), (kind, results) in zip(to_hash, pending):
+            if kind == 'compare':
+                for same in results():
+                    yield (size, None), same
+                continue
+            if kind == 'split':
+                # What to hash is only known now that the split is done
+                results = [pair for smaller in results()
+                           for pair in schedule_hashes(size, smaller, True)]
+            hashes = {}
+            for file_path, result in results:
+                if file_path is None:
+                    hashes.update(result())
+                else:
+                    hashes[file_path] = result()
+            checksums = defaultdict(list)
+            for file_path, info in group:
+                file_hash = known.get(file_path)
+                if file_hash is None:
+                    file_hash = hashes.get(file_path)
+                    if file_hash is None:
+                        continue  # Dropped as matching no other file
+                    if cache is not None:
+                        cache.store(info, algorithm, file_hash)
+                checksums[file_hash].append(file_path)
+            for file_hash, same in checksums.items():
+                if len(same) > 1:
+                    yield (size, file_hash), same
+    finally:
+        if executor is not None:
+            # Don't keep hashing if the caller stopped early
+            executor.shutdown(cancel_futures=True)
+
+def verify_duplicates(duplicates, blocksize=CHUNK_SIZE, drop_cache=True):
+    """Check groups from find_duplicates byte by byte.
+
+    Yields the same ((size, checksum), paths) groups, split or dropped
+    where files turn out to differ despite a matching checksum, which
+    only a hash collision can cause.
+    """
+    for (size, checksum), paths in duplicates:
+        if checksum is None:
+            # Empty, or already compared byte by byte
+            yield (size, checksum), paths
+            continue
+        for same in compare_in_lockstep(paths, size, blocksize, drop_cache):
+            yield (size, checksum), same
+
+def find_similar(directory, min_overlap=CDC_MIN_OVERLAP, jobs=None,
+                 algorithm=DEFAULT_HASH):
+    """Find pairs of files that share much of their content.
+
+    Files are split into content-defined chunks, so data that was shifted
+    by an insertion still lines up.  Returns (path1, path2, shared_bytes,
+    overlap) for every pair whose shared bytes are at least min_overlap of
+    the smaller file, most similar first, not counting chunks found in more
+    than CDC_MAX_SHARERS files.  Needs the fastcdc package.
+    """
+    def hash_function(data):
+        hasher = make_hasher(algorithm)
+        hasher.update(data)
+        return hasher
+    sizes = {}
+    chunk_map = defaultdict(set)
+    for file_path, info in scan_files(directory, jobs):
+        if info.size == 0:
+            continue
+        try:
+            for chunk in fastcdc.fastcdc(file_path, avg_size=CDC_AVG_SIZE,
+                                         hf=hash_function):
+                chunk_map[(chunk.hash, chunk.length)].add(file_path)
+        except OSError:
+            continue
+        sizes[file_path] = info.size
+
+    shared = defaultdict(int)
+    for (chunk_hash, length), paths in chunk_map.items():
+        if not 2 <= len(paths) <= CDC_MAX_SHARERS:
+            continue
+        paths = sorted(paths)
+        for i, path1 in enumerate(paths):
+            for path2 in paths[i + 1:]:
+                shared[(path1, path2)] += length
+
+    similar = []
+    for (path1, path2), shared_bytes in shared.items():
+        overlap = shared_bytes / min(sizes[path1], sizes[path2])
+        if overlap >= min_overlap:
+            similar.append((path1, path2, shared_bytes, overlap))
+    similar.sort(key=lambda pair: pair[3], reverse=True)
+    return similar
+
+def remove_file(file, dir_fd=None):
+    """Delete one file, returning a line that says how it went.
+
+    If dir_fd is an open descriptor for the file's directory, the file is
+    unlinked relative to it instead of by its full path.
+    """
+    try:
+        os.remove(file if dir_fd is None else os.path.basename(file), dir_fd=dir_fd)
+        return f"Deleted: {file}\n"
+    except FileNotFoundError:
+        return f"File not found: {file}\n"
+    except Exception as e:
+        return f"Error deleting file {file}: {e}\n"
+
+def remove_directory_files(directory, files):
+    """Delete files that are all in directory, returning remove_file's lines.
+
+    The directory is opened once, and only while its own files are being
+    unlinked, so they don't walk the whole path again one by one.
+    """
+    dir_fd = None
+    if os.remove in os.supports_dir_fd:
+        try:
+            dir_fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            pass  # Its files are removed by path, failing one by one if need be
+    try:
+        return [remove_file(file, dir_fd) for file in files]
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
 
 def delete_files(files):
     """Delete files from the filesystem."""
+    by_directory = defaultdict(list)
     for file in files:
-        try:
-            os.remove(file)
-            print(f"Deleted: {file}")
-        except FileNotFoundError:
-            print(f"File not found: {file}")
-        except Exception as e:
-            print(f"Error deleting file {file}: {e}")
-
-def prioritize_deletion(duplicates, debug=False):
-    """Prioritize files with parentheses for deletion."""
+        by_directory[os.path.dirname(file)].append(file)
+    # Unlinks are independent metadata operations that the filesystem can
+    # overlap, so each directory's batch goes to a thread pool, holding a
+    # descriptor only while it runs.  Report in one write, in list order.
+    lines = {}
+    with ThreadPoolExecutor(max_workers=DELETE_THREADS) as executor:
+        for batch, results in zip(by_directory.values(),
+                                  executor.map(remove_directory_files, by_directory,
+                                               by_directory.values())):
+            lines.update(zip(batch, results))
+    sys.stdout.write(''.join(lines[file] for file in files))
+
+def has_parentheses(file_path):
+    """Check whether a file's name contains parentheses."""
+    name = os.path.basename(file_path)
+    return '(' in name or ')' in name
+
+def prioritize_deletion(duplicates, debug=False, aliases=None):
+    """Prioritize files with parentheses for deletion.
+
+    aliases maps files to their other hard links, as collected by
+    find_duplicates.
+    """
+    aliases = aliases or {}
     files_to_delete = []
-    for paths in duplicates.values():
+    for checksum, paths in duplicates:
         if debug:
             print("Paths in current group:", paths)
         
-        with_parentheses = [p for p in paths if any(char in '()' for char in os.path.basename(p))]
+        # Classify each path once, splitting the group in a single pass
+        with_parentheses, without_parentheses = [], []
+        for p in paths:
+            (with_parentheses if has_parentheses(p) else without_parentheses).append(p)
         
         if debug:
             print("Files with parentheses:", with_parentheses)
         
-        if with_parentheses:
+        if with_parentheses and without_parentheses:
             files_to_delete.extend(with_parentheses)
         else:
-            # If no file with parentheses is found, delete all but the first file
-            files_to_delete.extend(paths[1:])  # Keep the first file, delete the rest
+            # If no file with parentheses is found, delete all but the first file.
+            # The same goes when they all have them, so one copy always survives.
+            # Deleting a file with other hard links frees nothing, so one of
+            # those is kept instead if there is one.
+            keep = next((p for p in paths if p in aliases), paths[0])
+            files_to_delete.extend(p for p in paths if p != keep)
     
     if debug:
         print("Files to delete after prioritization:", files_to_delete)
     
     return files_to_delete
 
-def interactive_delete(files):
-    """Interactively ask the user for confirmation to delete each file."""
-    for file in files:
-        size = get_file_size(file)
-        print(f"File: {file} ({size})")
-        confirmation = input("Do you want to delete this file? (y/n) ").strip().lower()
-        if confirmation == 'y':
-            try:
-                os.remove(file)
-                print(f"Deleted: {file}")
-            except FileNotFoundError:
-                print(f"File not found: {file}")
-            except Exception as e:
-                print(f"Error deleting file {file}: {e}")
-        else:
-            print(f"Skipped: {file}")
-
-def main(directory, interactive=False, debug=False):
-    duplicates = find_duplicates(directory)
-    if not duplicates:
-        print("No duplicate files found.")
-        return
-    
-    files_to_delete = prioritize_deletion(duplicates, debug)
-    
-    if files_to_delete:
-        if interactive:
-            print("Interactive mode enabled. Files proposed for deletion:")
-            interactive_delete(files_to_delete)
-        else:
-            print("Files proposed for deletion:")
-            for file in files_to_delete:
-                print(file)
-            
-            confirmation = input("Are you sure you want to delete these files? (y/n) ").strip().lower()
-            if confirmation == 'y':
-                delete_files(files_to_delete)
-            else:
-                print("No files were deleted.")
-
-
-def get_user_choice(files):
-    """Present files to user and get their choice."""
+def get_user_choice(files, size):
+    """Present files of the given size to user and get their choice."""
+    size = get_human_size(size)
     for i, file in enumerate(files, 1):
-        size = get_file_size(file)
         print(f"{i}: {file} ({size})")
 
     choices = "/".join([str(i) for i in range(1, len(files)+1)])
@@ -139,9 +981,11 @@ def get_user_choice(files):
 
 def interactive_delete(duplicates):
     """Interactively ask the user for confirmation to delete files."""
-    for checksum, files in duplicates.items():
+    for (size, checksum), files in duplicates:
         print("\nDuplicate files found:")
-        choice = get_user_choice(files)
+        # Every file in a group has the size it was bucketed by, so there
+        # is no need to stat them again
+        choice = get_user_choice(files, size)
 
         if choice == 'abort':
             return False  # Signal to main function that we're aborting
@@ -157,34 +1001,65 @@ def interactive_delete(duplicates):
             for index in choice:
                 files_to_delete.append(files[int(index) - 1])
 
-        for file in files_to_delete:
-            try:
-                os.remove(file)
-                print(f"Deleted: {file}")
-            except FileNotFoundError:
-                print(f"File not found: {file}")
-            except Exception as e:
-                print(f"Error deleting file {file}: {e}")
+        # Only a file or two, not worth delete_files' threads
+        sys.stdout.write(''.join(remove_file(file) for file in files_to_delete))
 
     return True  # Signal successful completion
 
-def main(directory, interactive=False, debug=False):
+def main(directory, interactive=False, debug=False, cdc=False, algorithm=DEFAULT_HASH, jobs=None, cache_path=CACHE_PATH,
+         prefix_size=HEAD_SIZE, blocksize=CHUNK_SIZE, verify=False, drop_cache=True):
+    cache = None
     try:
-        duplicates = find_duplicates(directory)
-        if not duplicates:
+        if algorithm not in _BASE_HASHERS:
+            package = 'blake3' if algorithm == 'blake3' else 'xxhash'
+            print(f"The {package} package is not installed, using MD5 instead.")
+            algorithm = 'md5'
+
+        if cdc:
+            if fastcdc is None:
+                print("The --cdc option needs the fastcdc package (pip install fastcdc).")
+                return
+            similar = find_similar(directory, jobs=jobs, algorithm=algorithm)
+            if not similar:
+                print("No similar files found.")
+            sys.stdout.write("".join(f"{overlap:.0%} shared ({get_human_size(shared_bytes)}): {path1} and {path2}\n"
+                                     for path1, path2, shared_bytes, overlap in similar))
+            return
+
+        if jobs is None and is_rotational(directory):
+            # Parallel reads make a hard disk seek between files, which is
+            # slower than reading them one at a time
+            jobs = 1
+            print("Spinning disk detected, scanning and hashing serially "
+                  "(use -j to override).")
+
+        if cache_path is not None:
+            try:
+                cache = HashCache(cache_path)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Not using the hash cache: {e}")
+        aliases = {}
+        duplicates = find_duplicates(directory, jobs=jobs, debug=debug, algorithm=algorithm, cache=cache,
+                                     prefix_size=prefix_size, blocksize=blocksize, aliases=aliases,
+                                     # --verify reads the duplicates again right after
+                                     drop_cache=drop_cache and not verify)
+        if verify:
+            duplicates = verify_duplicates(duplicates, blocksize, drop_cache)
+        first = next(duplicates, None)
+        if first is None:
             print("No duplicate files found.")
             return
+        duplicates = chain([first], duplicates)
         
         if interactive:
             print("Interactive mode enabled.")
             if not interactive_delete(duplicates):
                 return
         else:
-            files_to_delete = prioritize_deletion(duplicates, debug)
+            files_to_delete = prioritize_deletion(duplicates, debug, aliases)
             if files_to_delete:
-                print("Files proposed for deletion:")
-                for file in files_to_delete:
-                    print(file)
+                # One write for the whole list, which can run to thousands of lines
+                sys.stdout.write("Files proposed for deletion:\n" + "".join(f"{file}\n" for file in files_to_delete))
                 
                 confirmation = input("Are you sure you want to delete these files? (y/n) ").strip().lower()
                 if confirmation == 'y':
@@ -195,15 +1070,45 @@ def main(directory, interactive=False, debug=False):
         print("\nOperation cancelled by user.")
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        if cache is not None:
+            cache.close()
 
+# Command-line help.
+_DESCRIPTION = "Find and delete duplicate files."
+_EPILOG = ("Hashes: blake3 is cryptographic and the fastest on most machines, using "
+           "several cores for large files.  xxh3 is as fast or faster but not "
+           "cryptographic, which only matters if someone could craft files to collide.  "
+           "md5 needs no extra package but is several times slower.  The default is "
+           "blake3 if it is installed and md5 otherwise; xxh3 is only used when picked.")
 
-if __name__ == "__main__":
-    parser = ArgumentParser(description="Find and delete duplicate files.")
+def _build_parser():
+    """Return the parser for the command-line options."""
+    parser = ArgumentParser(description=_DESCRIPTION, epilog=_EPILOG)
     parser.add_argument('directory', nargs='?', default='.', help="Directory to scan for duplicate files.")
     parser.add_argument('-i', '--interactive', action='store_true', help="Enable interactive mode to confirm deletions.")
     parser.add_argument('--debug', action='store_true', help="Enable debugging output.")
-
-    args = parser.parse_args()
-    main(args.directory, interactive=args.interactive, debug=args.debug)
+    parser.add_argument('--hash', choices=HASH_ALGORITHMS, default=DEFAULT_HASH, help="Hash algorithm used to compare files (default: %(default)s). blake3 and xxh3 need their packages installed.")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of parallel workers for scanning and hashing (default: 1 on a spinning disk, otherwise one per CPU core, up to 8 for hashing).")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or save checksums in the hash cache.")
+    parser.add_argument('--cache-path', default=CACHE_PATH, help="Where the hash cache is kept (default: %(default)s).")
+    parser.add_argument('--prefix-size', type=int, default=HEAD_SIZE, help=f"Bytes read from the start of each same-size file to rule it out before hashing all of it (default: %(default)s, at most {MAX_HEAD_SIZE}).")
+    parser.add_argument('-b', '--blocksize', type=int, default=CHUNK_SIZE, help="Read size in bytes used when hashing whole files (default: %(default)s).")
+    parser.add_argument('--verify', action='store_true', help="Compare files with matching checksums byte by byte before offering to delete them.")
+    parser.add_argument('--keep-page-cache', action='store_true', help="Leave hashed files in the OS page cache instead of dropping them once read.")
+    parser.add_argument('--cdc', action='store_true', help="Report files that share most of their content instead of deleting exact duplicates (needs fastcdc).")
+    return parser
 
 
+if __name__ == "__main__":
+    parser = _build_parser()
+    args = parser.parse_args()
+    if not 1 <= args.prefix_size <= MAX_HEAD_SIZE:
+        parser.error(f"--prefix-size must be between 1 and {MAX_HEAD_SIZE}")
+    if args.blocksize < 1:
+        parser.error("--blocksize must be at least 1")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    main(args.directory, interactive=args.interactive, debug=args.debug, cdc=args.cdc, algorithm=args.hash, jobs=args.jobs, cache_path=None if args.no_cache else args.cache_path,
+         prefix_size=args.prefix_size, blocksize=args.blocksize, verify=args.verify,
+         drop_cache=not args.keep_page_cache)
@@ -0,0 +1,234 @@
+"""Tests for rmdup.py.
+
+Run with python -m pytest or python -m unittest discover tests.
+"""
+
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rmdup  # noqa: E402
+
+
+def make_tree(root):
+    """Fill root with files, many of them duplicates, and return their paths."""
+    rng = random.Random(0)
+    contents = []
+    # Groups of copies, with the odd file that only differs near the
+    # start, near the end or in the middle
+    for size in (1, 100, 5000, rmdup.HEAD_SIZE + 1, 3 * rmdup.CHUNK_SIZE + 17):
+        data = rng.randbytes(size)
+        contents += [data] * 3
+        middle = size // 2
+        for at in (0, middle, size - 1):
+            contents.append(data[:at] + bytes([data[at] ^ 1]) + data[at + 1:])
+    # Enough copies of one file to be split by sampling windows
+    data = rng.randbytes(200000)
+    contents += [data] * (rmdup.LOCKSTEP_MAX_FILES + 4)
+    contents += [data[:-1] + b'x'] * 3
+    # Empty files, and unique files sharing a size
+    contents += [b''] * 3
+    contents += [rng.randbytes(70000) for i in range(4)]
+
+    paths = []
+    for i, data in enumerate(contents):
+        directory = os.path.join(root, f"d{i % 7}", f"e{i % 3}")
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, f"file{i} (1).bin" if i % 5 == 0 else f"file{i}.bin")
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        paths.append(file_path)
+    return paths
+
+
+def reference_groups(paths):
+    """Group paths by content the slow way."""
+    by_content = defaultdict(list)
+    for file_path in paths:
+        with open(file_path, 'rb') as f:
+            by_content[f.read()].append(file_path)
+    return {frozenset(group) for group in by_content.values() if len(group) > 1}
+
+
+def as_groups(duplicates):
+    """Turn find_duplicates output into a set of path sets."""
+    groups = [frozenset(paths) for (size, checksum), paths in duplicates]
+    assert len(groups) == len(set(groups))
+    return set(groups)
+
+
+class FindDuplicatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tree = os.path.join(self.root, 'tree')
+        self.paths = make_tree(self.tree)
+        self.expected = reference_groups(self.paths)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, **kwargs):
+        self.assertEqual(as_groups(rmdup.find_duplicates(self.tree, **kwargs)), self.expected)
+
+    def test_default(self):
+        self.check()
+
+    def test_single_job(self):
+        self.check(jobs=1)
+
+    def test_without_cache(self):
+        self.check(cache=None, jobs=2)
+
+    def test_small_reads(self):
+        self.check(prefix_size=3, blocksize=5)
+        self.check(prefix_size=3, blocksize=5, jobs=1)
+
+    def test_verify(self):
+        duplicates = rmdup.find_duplicates(self.tree)
+        self.assertEqual(as_groups(rmdup.verify_duplicates(duplicates)), self.expected)
+
+    def test_cache_round_trip(self):
+        # Files written within RACY_MTIME_NS are not cached, so age them
+        old = time.time() - 3600
+        for file_path in self.paths:
+            os.utime(file_path, (old, old))
+        cache_path = os.path.join(self.root, 'cache.db')
+        for run in range(2):
+            cache = rmdup.HashCache(cache_path)
+            try:
+                self.check(cache=cache)
+            finally:
+                cache.close()
+
+        # Something was cached and is found again
+        cache = rmdup.HashCache(cache_path)
+        try:
+            hits = 0
+            for file_path in self.paths:
+                st = os.stat(file_path)
+                info = rmdup.FileInfo(st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                                      st.st_dev, st.st_ino)
+                hits += cache.lookup(info, rmdup.DEFAULT_HASH) is not None
+            self.assertGreater(hits, 0)
+
+            # A file edited in place is not matched by its old checksum,
+            # even with its mtime set back.  The edit is in the middle,
+            # where the quick pass doesn't look.
+            changed = next(iter(max(self.expected, key=len)))
+            with open(changed, 'r+b') as f:
+                f.seek(os.path.getsize(changed) // 2)
+                byte = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([byte[0] ^ 1]))
+            os.utime(changed, (old, old))
+            self.expected = reference_groups(self.paths)
+            self.check(cache=cache)
+        finally:
+            cache.close()
+
+    def test_cache_write_error(self):
+        old = time.time() - 3600
+        for file_path in self.paths:
+            os.utime(file_path, (old, old))
+        cache = rmdup.HashCache(os.path.join(self.root, 'cache.db'))
+        # As if the database belonged to another user
+        cache.db.execute("PRAGMA query_only = ON")
+        try:
+            self.check(cache=cache)
+        finally:
+            cache.close()
+        self.assertTrue(cache.failed)
+
+
+class HashInLockstepTest(unittest.TestCase):
+
+    def test_matches_get_hash(self):
+        root = tempfile.mkdtemp()
+        try:
+            size = rmdup.PARALLEL_HASH_THRESHOLD + rmdup.CHUNK_SIZE + 123
+            data = bytearray(random.Random(1).randbytes(size))
+            paths = [os.path.join(root, name) for name in ('a', 'b', 'c')]
+            for file_path in paths[:2]:
+                with open(file_path, 'wb') as f:
+                    f.write(data)
+            data[size // 2] ^= 1
+            with open(paths[2], 'wb') as f:
+                f.write(data)
+            del data
+
+            for algorithm in rmdup._BASE_HASHERS:
+                with self.subTest(algorithm=algorithm):
+                    checksums = rmdup.hash_in_lockstep(paths, size, algorithm)
+                    self.assertEqual(sorted(checksums), paths[:2])
+                    for file_path in paths[:2]:
+                        self.assertEqual(checksums[file_path],
+                                         rmdup.get_hash(file_path, size, algorithm))
+        finally:
+            shutil.rmtree(root)
+
+
+class PrioritizeDeletionTest(unittest.TestCase):
+
+    def delete(self, *groups, aliases=None):
+        duplicates = [((1, b'x'), list(paths)) for paths in groups]
+        return rmdup.prioritize_deletion(duplicates, aliases=aliases)
+
+    def test_mixed_group_deletes_files_with_parentheses(self):
+        self.assertEqual(self.delete(['a/photo.jpg', 'b/photo (1).jpg', 'c/photo(2).jpg']),
+                         ['b/photo (1).jpg', 'c/photo(2).jpg'])
+
+    def test_all_parentheses_keeps_the_first(self):
+        self.assertEqual(self.delete(['a/x (1).txt', 'b/x (2).txt', 'c/x (3).txt']),
+                         ['b/x (2).txt', 'c/x (3).txt'])
+
+    def test_no_parentheses_keeps_the_first(self):
+        self.assertEqual(self.delete(['a/x.txt', 'b/x.txt']), ['b/x.txt'])
+
+    def test_keeps_the_file_with_other_hard_links(self):
+        aliases = {'b/x.txt': ['c/link.txt']}
+        self.assertEqual(self.delete(['a/x.txt', 'b/x.txt', 'd/x.txt'], aliases=aliases),
+                         ['a/x.txt', 'd/x.txt'])
+        self.assertEqual(self.delete(['a/x (1).txt', 'b/x (2).txt'], aliases={'b/x (2).txt': ['c']}),
+                         ['a/x (1).txt'])
+
+    def test_one_file_survives_each_group(self):
+        groups = [['a/1', 'b/1'], ['a/2 (1)', 'b/2 (1)'], ['a/3', 'b/3 (1)']]
+        deleted = set(self.delete(*groups))
+        for paths in groups:
+            self.assertTrue(set(paths) - deleted)
+
+
+class DeleteFilesTest(unittest.TestCase):
+
+    def test_deletes_only_the_given_files(self):
+        root = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(20):
+                directory = os.path.join(root, f"d{i % 6}")
+                os.makedirs(directory, exist_ok=True)
+                paths.append(os.path.join(directory, f"f{i}"))
+                with open(paths[-1], 'w') as f:
+                    f.write("x")
+            missing = os.path.join(root, 'd0', 'missing')
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                rmdup.delete_files(paths[::2] + [missing])
+            self.assertEqual([os.path.exists(p) for p in paths], [i % 2 == 1 for i in range(20)])
+            self.assertEqual(out.getvalue().splitlines(),
+                             [f"Deleted: {p}" for p in paths[::2]] + [f"File not found: {missing}"])
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()